@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import codecs
+import numpy as np
+from glob import glob
+from os import path, cpu_count
+from concurrent.futures import ProcessPoolExecutor
+
+from game import Game
+
+
+class Cohort:
+
+	FACTORS = {"stage": Game.STAGES, "opponent": Game.OPPONENTS, "strategy": Game.STRATEGIES}
+	CHUNK = 2000  # resamples per worker task, independent of cores for reproducibility
+
+	def __init__(self, sids, subject, bot, labels):
+		"""Init Cohort class from per-subject, per-match arrays."""
+		self.sids = np.asarray(sids)  # (subjects,)
+		self.subject = np.asarray(subject, dtype=float)  # (subjects, matches, rounds), 1=cooperate, NaN=not played
+		self.bot = np.asarray(bot, dtype=float)  # same as above for the bots' moves
+		self.labels = {key: np.asarray(value, dtype=int) for key, value in labels.items()}  # (subjects, matches)
+
+	@classmethod
+	def load(cls, log_folder, info="*_info.csv", game="*_game.csv"):
+		"""Load cohort from the server's CSV logs, opponents are regenerated from the subject ID seed."""
+		if not path.isdir(log_folder):
+			raise IOError(f'ERROR! "{log_folder}" is not a valid directory.')
+		profiles = {}
+		for sid, key, value in cls._read(sorted(glob(path.join(log_folder, info)))):
+			if key in ("avatar", "gender"):
+				profiles.setdefault(sid, {})[key] = value
+		moves, current = {}, {}
+		for sid, key, value in cls._read(sorted(glob(path.join(log_folder, game)))):
+			if key == "searching":
+				current[sid] = int(value)
+				moves.setdefault(sid, {})[current[sid]] = {"move_subject": [], "move_bot": []}
+			elif key in ("move_subject", "move_bot") and sid in current:
+				moves[sid][current[sid]][key].append(value == "True")
+
+		matches = len(Game.STAGES) + 1  # including rematch
+		rounds = Game.NUMBER_OF_GAMES
+		sids, subject, bot = [], [], []
+		labels = {key: [] for key in cls.FACTORS}
+		for sid in sorted(moves, key=int):
+			if sid not in profiles or len(profiles[sid]) < 2:
+				continue  # can not regenerate opponents without avatar and gender
+			avatar, gender = profiles[sid]["avatar"], bool(profiles[sid]["gender"])  # same as server
+			bots = Game(int(sid)).generate(avatar, gender).bots
+			sids.append(int(sid))
+			subject.append(np.full((matches, rounds), np.nan))
+			bot.append(np.full((matches, rounds), np.nan))
+			for match, played in moves[sid].items():
+				n = min(rounds, len(played["move_subject"]), len(played["move_bot"]))
+				subject[-1][match, :n] = played["move_subject"][:n]
+				bot[-1][match, :n] = played["move_bot"][:n]
+			# the mirror opponent was replaced by the subject's own avatar and gender
+			opponents = ["mirror" if b.avatar == avatar and bool(b.gender) == gender else b.avatar for b in bots]
+			labels["stage"].append([Game.STAGES.index(b.stage) for b in bots])
+			labels["opponent"].append([Game.OPPONENTS.index(o) for o in opponents])
+			labels["strategy"].append([Game.STRATEGIES.index(b.strategy) for b in bots])
+		if not sids:
+			raise ValueError(f'No complete subject logs were found in "{log_folder}".')
+		return cls(sids, subject, bot, labels)
+
+	@staticmethod
+	def _read(files):
+		"""Yield (sid, key, value) rows of server CSV logs."""
+		for file in files:
+			with codecs.open(file, "r", encoding="utf-8") as f:
+				for line in f:
+					row = line.rstrip("\r\n").split(";")
+					if len(row) >= 4:
+						yield row[1], row[2], row[3]
+
+	def cooperation(self):
+		"""Return cooperation rate of each subject in each match, NaN if match was not played."""
+		played = np.sum(~np.isnan(self.subject), axis=2)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return np.nansum(self.subject, axis=2) / played
+
+	def bootstrap(self, factor, resamples=10000, alpha=.05, seed=None, jobs=None):
+		"""Cluster bootstrap (resampling subjects) confidence intervals of cooperation for each level of factor."""
+		levels = self.FACTORS[factor]
+		sums, counts = self._by_subject(self.cooperation(), self.labels[factor], len(levels))
+		means = self._resample(_bootstrap_chunk, (sums, counts), resamples, seed, jobs)
+		with np.errstate(invalid="ignore", divide="ignore"):
+			observed = sums.sum(axis=0) / counts.sum(axis=0)
+		low, high = np.nanpercentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+		return {level: {"mean": float(observed[i]), "low": float(low[i]), "high": float(high[i]), "n": int(counts[:, i].sum())}
+				for i, level in enumerate(levels)}
+
+	def permutation(self, factor, resamples=10000, seed=None, jobs=None):
+		"""Permutation test of factor, labels are shuffled within subjects (each subject sees every level)."""
+		coop = self.cooperation()
+		labels = self.labels[factor]
+		observed = _between(coop[None], labels[None], len(self.FACTORS[factor]))[0]
+		stats = self._resample(_permutation_chunk, (coop, labels, len(self.FACTORS[factor])), resamples, seed, jobs)
+		return {"statistic": float(observed), "p": float((1 + np.sum(stats >= observed)) / (1 + len(stats)))}
+
+	def rematch(self, resamples=10000, alpha=.05, seed=None, jobs=None):
+		"""Paired change in cooperation when meeting the same opponent in the same stage again."""
+		coop = self.cooperation()
+		diff = coop[:, Game.DUPLICATE_TO] - coop[:, Game.DUPLICATE_FROM]
+		diff = diff[~np.isnan(diff)]
+		if not diff.size:
+			raise ValueError("No subject has played both the original match and the rematch.")
+		observed = diff.mean()
+		# independent streams for the confidence interval and the p-value
+		seed_bootstrap, seed_permutation = np.random.SeedSequence(seed).spawn(2)
+		means = self._resample(_bootstrap_chunk, (diff[:, None], np.ones((diff.size, 1))), resamples, seed_bootstrap, jobs)[:, 0]
+		stats = self._resample(_sign_flip_chunk, (diff,), resamples, seed_permutation, jobs)
+		low, high = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+		return {"mean": float(observed), "low": float(low), "high": float(high), "n": int(diff.size),
+				"p": float((1 + np.sum(np.abs(stats) >= abs(observed))) / (1 + len(stats)))}
+
+	@staticmethod
+	def _by_subject(values, labels, levels):
+		"""Sum and count non-NaN values of each subject by label, both (subjects, levels)."""
+		valid = ~np.isnan(values)
+		index = (np.arange(len(values))[:, None] * levels + labels)[valid]
+		size = len(values) * levels
+		sums = np.bincount(index, weights=values[valid], minlength=size).reshape(-1, levels)
+		counts = np.bincount(index, minlength=size).reshape(-1, levels).astype(float)
+		return sums, counts
+
+	@classmethod
+	def _resample(cls, function, args, resamples, seed, jobs):
+		"""Split resamples into seeded chunks and run them on multiple cores."""
+		sizes = [cls.CHUNK] * (resamples // cls.CHUNK) + ([resamples % cls.CHUNK] if resamples % cls.CHUNK else [])
+		seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+		seeds = seed.spawn(len(sizes))
+		jobs = min(jobs or cpu_count() or 1, len(sizes))
+		if jobs <= 1:
+			return np.concatenate([function(*args, size, s) for size, s in zip(sizes, seeds)])
+		with ProcessPoolExecutor(max_workers=jobs) as executor:
+			futures = [executor.submit(function, *args, size, s) for size, s in zip(sizes, seeds)]
+			return np.concatenate([future.result() for future in futures])
+
+
+def _between(coop, labels, levels):
+	"""Between-level sum of squares of cooperation for each (resample, subject, match) array."""
+	resamples = len(labels)
+	valid = np.broadcast_to(~np.isnan(coop), labels.shape)
+	values = np.broadcast_to(coop, labels.shape)[valid]
+	index = (np.arange(resamples)[:, None, None] * levels + labels)[valid]
+	sums = np.bincount(index, weights=values, minlength=resamples * levels).reshape(resamples, levels)
+	counts = np.bincount(index, minlength=resamples * levels).reshape(resamples, levels)
+	grand = sums.sum(axis=1, keepdims=True) / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		means = np.where(counts > 0, sums / counts, grand)
+	return np.sum(counts * (means - grand) ** 2, axis=1)
+
+
+def _bootstrap_chunk(sums, counts, size, seed):
+	"""Level means of "size" cluster bootstrap resamples, subjects are drawn with replacement."""
+	rng = np.random.default_rng(seed)
+	subjects = len(sums)
+	weights = rng.multinomial(subjects, np.full(subjects, 1. / subjects), size=size)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return (weights @ sums) / (weights @ counts)
+
+
+def _permutation_chunk(coop, labels, levels, size, seed):
+	"""Between-level statistic of "size" within-subject label permutations."""
+	rng = np.random.default_rng(seed)
+	order = np.argsort(rng.random((size, *labels.shape)), axis=2)
+	return _between(coop[None], np.take_along_axis(labels[None], order, axis=2), levels)
+
+
+def _sign_flip_chunk(diff, size, seed):
+	"""Mean of "size" paired differences with randomly flipped signs."""
+	rng = np.random.default_rng(seed)
+	return (rng.choice([-1., 1.], size=(size, diff.size)) * diff).mean(axis=1)
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser("Test effects of stage, opponent, strategy and rematch on cooperation")
+	parser.add_argument("--log_folder", help="Folder for logs", type=str, default="../experiments", required=False)
+	parser.add_argument("--log_info", help="Pattern of Info logs in 'log_folder'", type=str, default="*_info.csv", required=False)
+	parser.add_argument("--log_game", help="Pattern of Game logs in 'log_folder'", type=str, default="*_game.csv", required=False)
+	parser.add_argument("--resamples", help="Number of bootstrap and permutation resamples", type=int, default=100000, required=False)
+	parser.add_argument("--alpha", help="Significance level of confidence intervals", type=float, default=.05, required=False)
+	parser.add_argument("--seed", help="Random seed for reproducible results", type=int, default=0, required=False)
+	parser.add_argument("--jobs", help="Number of processes, defaults to number of cores", type=int, default=0, required=False)
+	args = parser.parse_args()
+
+	cohort = Cohort.load(args.log_folder, info=args.log_info, game=args.log_game)
+	print(f'{len(cohort.sids)} subjects, {args.resamples} resamples')
+	for factor in Cohort.FACTORS:
+		test = cohort.permutation(factor, args.resamples, seed=args.seed, jobs=args.jobs)
+		print(f'\n{factor}: between-level SS={test["statistic"]:.4f}, p={test["p"]:.5f}')
+		for level, ci in cohort.bootstrap(factor, args.resamples, args.alpha, seed=args.seed, jobs=args.jobs).items():
+			print(f'\t{level:<10} {ci["mean"]:.3f} [{ci["low"]:.3f}, {ci["high"]:.3f}] n={ci["n"]}')
+	test = cohort.rematch(args.resamples, args.alpha, seed=args.seed, jobs=args.jobs)
+	print(f'\nrematch: {test["mean"]:+.3f} [{test["low"]:+.3f}, {test["high"]:+.3f}] n={test["n"]}, p={test["p"]:.5f}')
@@ -11,6 +11,7 @@ class Game:
 	M_NICKS = [f'Ős Klára {i}' for i in range(20)]  # TODO: ad list of names
 	COLORS = ["red", "green"]
 	STRATEGIES = ["tft", "grim", "pavlov", "susp_tft", "hard_majo", "per_dc", "all_c", "all_d", "random"]
+	STOCHASTIC = ["random"]  # moves of these strategies do not depend on history
 	STAGES = ["temple", "jail", "lab", "home", "forest", "station", "beach", "junkyard", "tron"]
 	OPPONENTS = ["mirror", "unknown", "doctor", "pirate", "robot", "king", "old", "young", "foreigner"]
 	DUPLICATE_FROM = 2
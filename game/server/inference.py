@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from game import Game, Bot
+from analysis import Cohort
+
+
+class Inference:
+
+	def __init__(self, cohort, errors=None):
+		"""Init Inference class, moves of all subjects are predicted by all strategies of the Bots."""
+		self.cohort = cohort
+		self.strategies = list(Game.STRATEGIES)
+		self.errors = np.linspace(.01, .5, 50) if errors is None else np.asarray(errors, dtype=float)
+		self.stochastic = np.array([strategy in Game.STOCHASTIC for strategy in self.strategies])
+		self.predicted = self.predict(cohort.subject, cohort.bot)  # (subjects, matches, rounds, strategies)
+
+	def predict(self, subject, opponent):
+		"""Replay every match with each strategy in the subject's place, NaN if not played or stochastic."""
+		predicted = np.full((*subject.shape, len(self.strategies)), np.nan)
+		for k, strategy in enumerate(self.strategies):
+			if self.stochastic[k]:
+				continue
+			for s, m in zip(*np.where(~np.isnan(subject[:, :, 0]) & ~np.isnan(opponent[:, :, 0]))):
+				# the strategy plays as the "bot", the actual opponent as the "subject"
+				bot = Bot("", "", False, "", strategy, subject.shape[2])
+				for r in range(subject.shape[2]):
+					if np.isnan(subject[s, m, r]) or np.isnan(opponent[s, m, r]):
+						break
+					predicted[s, m, r, k] = bool(bot.move())
+					bot.play(bool(subject[s, m, r]), bool(opponent[s, m, r]))
+		return predicted
+
+	def likelihood(self):
+		"""Log-likelihood of each subject's moves for each strategy and error rate, (subjects, strategies, errors)."""
+		moves = self.cohort.subject[..., None]
+		played = ~np.isnan(moves) & ~np.isnan(self.cohort.bot[..., None])
+		total = np.sum(played, axis=(1, 2, 3)).astype(float)  # (subjects,)
+		agree = np.sum(played & (moves == self.predicted), axis=(1, 2)).astype(float)  # (subjects, strategies)
+		log_error, log_correct = np.log(self.errors), np.log1p(-self.errors)
+		ll = agree[..., None] * log_correct + (total[:, None, None] - agree[..., None]) * log_error
+		# random moves are right or wrong by chance regardless of error rate
+		ll[:, self.stochastic, :] = (total * np.log(.5))[:, None, None]
+		return ll
+
+	def classify(self):
+		"""Maximum likelihood strategy and error rate of each subject."""
+		ll = self.likelihood()
+		best = ll.reshape(len(ll), -1).argmax(axis=1)
+		k, e = np.unravel_index(best, ll.shape[1:])
+		return {int(sid): {"strategy": self.strategies[k[i]], "error": float(self.errors[e[i]]), "ll": float(ll[i, k[i], e[i]])}
+				for i, sid in enumerate(self.cohort.sids)}
+
+	def mixture(self, iterations=1000, tolerance=1e-9):
+		"""Strategy frequency estimation: EM of strategy shares with a common error rate, for all error rates at once."""
+		ll = self.likelihood()
+		subjects, strategies, errors = ll.shape
+		shares = np.full((strategies, errors), 1. / strategies)
+		previous = -np.inf
+		for _ in range(iterations):
+			joint = np.log(shares) + ll  # (subjects, strategies, errors)
+			peak = joint.max(axis=1, keepdims=True)
+			marginal = peak + np.log(np.exp(joint - peak).sum(axis=1, keepdims=True))
+			posterior = np.exp(joint - marginal)
+			shares = np.clip(posterior.mean(axis=0), 1e-300, None)
+			total = marginal.sum(axis=(0, 1))  # (errors,)
+			if np.all(np.abs(total - previous) < tolerance):
+				break
+			previous = total
+		e = int(total.argmax())
+		return {
+			"error": float(self.errors[e]),
+			"ll": float(total[e]),
+			"shares": {strategy: float(shares[k, e]) for k, strategy in enumerate(self.strategies)},
+			"subjects": {int(sid): self.strategies[posterior[i, :, e].argmax()] for i, sid in enumerate(self.cohort.sids)},
+		}
+
+	def check_bots(self):
+		"""Return the number of logged bot moves that differ from their regenerated strategy, should be 0."""
+		mismatch = 0
+		strategies = self.cohort.labels["strategy"]
+		for s, m in zip(*np.where(~np.isnan(self.cohort.bot[:, :, 0]))):
+			strategy = Game.STRATEGIES[strategies[s, m]]
+			if strategy in Game.STOCHASTIC:
+				continue
+			replay = self.predict(self.cohort.bot[s:s + 1, m:m + 1], self.cohort.subject[s:s + 1, m:m + 1])
+			replay = replay[0, 0, :, self.strategies.index(strategy)]
+			played = ~np.isnan(replay)
+			mismatch += int(np.sum(replay[played] != self.cohort.bot[s, m][played]))
+		return mismatch
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser("Estimate which Bot strategies explain the subjects' play")
+	parser.add_argument("--log_folder", help="Folder for logs", type=str, default="../experiments", required=False)
+	parser.add_argument("--log_info", help="Pattern of Info logs in 'log_folder'", type=str, default="*_info.csv", required=False)
+	parser.add_argument("--log_game", help="Pattern of Game logs in 'log_folder'", type=str, default="*_game.csv", required=False)
+	args = parser.parse_args()
+
+	inference = Inference(Cohort.load(args.log_folder, info=args.log_info, game=args.log_game))
+	mismatch = inference.check_bots()
+	if mismatch:
+		print(f'WARNING! {mismatch} logged bot moves differ from the current strategy definitions.')
+	result = inference.mixture()
+	print(f'Strategy frequencies (error rate {result["error"]:.2f}, log-likelihood {result["ll"]:.2f}):')
+	for strategy, share in sorted(result["shares"].items(), key=lambda x: -x[1]):
+		print(f'\t{strategy:<10} {share:.3f}')
+	print('\nSubjects (mixture posterior / maximum likelihood):')
+	for sid, ml in inference.classify().items():
+		print(f'\t{sid:<6} {result["subjects"][sid]:<10} {ml["strategy"]:<10} error={ml["error"]:.2f}')
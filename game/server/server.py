@@ -2,26 +2,44 @@
 # -*- coding: utf-8 -*-
 
 import codecs
+import gzip
+import hashlib
 import json
 import asyncio
 import websockets
 import atexit
+from http import HTTPStatus
 from socket import gethostbyname, gethostname
 from datetime import datetime
-from os import path
+from os import path, walk
 
 from game import Game
 
 
 class Server:
 
+	CONTENT_TYPES = {
+		".html": "text/html; charset=utf-8",
+		".css": "text/css; charset=utf-8",
+		".js": "application/javascript; charset=utf-8",
+	}
+	INDEX = "/login.html"
+	MAX_ERRORS = 16  # error categories tracked per connection for rate-limited logging
+
 	def __init__(self, ip="", port=42069,
-				log_level=3, log_folder="", log_info="", log_game=""):
+				log_level=3, log_folder="", log_info="", log_game="",
+				rate_limit=20., rate_burst=40, max_size=2 ** 16, max_keys=16, log_interval=5.,
+				static_folder=""):
 		"""Init Server class. Will run on local IP:42069 by default."""
 
 		self.ip = ip if ip else gethostbyname(gethostname())
 		self.port = port
 		self.frequency = 1.0 / 10.  # fps=10
+		self.rate_limit = float(rate_limit)  # messages / second / connection
+		self.rate_burst = float(rate_burst)  # size of token bucket
+		self.max_size = int(max_size)  # bytes / frame, enforced by websockets
+		self.max_keys = int(max_keys)  # keys / "data" dict
+		self.log_interval = float(log_interval)  # seconds between repeated errors
 		self.log_level = log_level
 		self.log_info = log_info
 		self.log_game = log_game
@@ -29,6 +47,9 @@ class Server:
 			self.log_folder = log_folder
 		else:
 			raise IOError(f'ERROR! "{log_folder}" is not a valid directory.')
+		if static_folder and not path.isdir(static_folder):
+			raise IOError(f'ERROR! "{static_folder}" is not a valid directory.')
+		self.assets = self.load_assets(static_folder) if static_folder else {}
 
 		self.connections = {}
 		self.environment = {}
@@ -42,9 +63,12 @@ class Server:
 	# start server
 	def run(self):
 		"""Run server based on class information."""
-		self.service = websockets.serve(self.thread, self.ip, self.port)
+		self.service = websockets.serve(self.thread, self.ip, self.port, max_size=self.max_size,
+										process_request=self.serve_asset if self.assets else None)
 		self.tasks = [asyncio.ensure_future(self.service), asyncio.ensure_future(self.tic())]
 		self.log(f'Server starting at {self.ip}:{self.port}')
+		if self.assets:
+			self.log(f'Serving {len(self.assets)} files, open http://{self.ip}:{self.port}{self.INDEX}')
 		try:
 			self.loop.run_until_complete(asyncio.gather(*self.tasks))
 			self.loop.run_forever()
@@ -77,6 +101,27 @@ class Server:
 			else:
 				print(f'{self.now("%H:%M:%S")} > {msg}')
 
+	def log_client(self, client, error, msg, level=0):
+		"""Print client errors, summarising repeated errors of the same category within "log_interval" seconds."""
+		if level > self.log_level:
+			return
+		if client not in self.connections:
+			self.log(msg, level)
+			return
+		errors = self.connections[client]["errors"]
+		if error not in errors and len(errors) >= self.MAX_ERRORS:
+			error = "other"  # keep the number of tracked categories bounded
+		now = self.now()
+		if error in errors and now - errors[error]["logged"] < self.log_interval:
+			errors[error]["repeated"] += 1
+			errors[error]["msg"] = msg  # last one is shown in the summary
+			return
+		if error in errors and errors[error]["repeated"]:
+			self.log(f'{msg} ({error} repeated {errors[error]["repeated"]} more times)', level)
+		else:
+			self.log(msg, level)
+		errors[error] = {"logged": now, "repeated": 0, "msg": msg}
+
 	def _save_data(self, file, key, value):
 		if not self.environment or "sid" not in self.environment:
 			self.log("ERROR! Experiment environment is not yet set up, can not save to CSV.", 1)
@@ -112,6 +157,47 @@ class Server:
 			return f'{self.connections[client]["ip"]} ({self.connections[client]["type"]})'
 		return f'{self.connections[client]["ip"]}'
 
+	def load_assets(self, folder):
+		"""Read and precompress static frontend files into memory."""
+		assets = {}
+		for root, _, files in walk(folder):
+			for file in files:
+				extension = path.splitext(file)[1].lower()
+				if extension not in self.CONTENT_TYPES:
+					continue
+				name = "/" + path.relpath(path.join(root, file), folder).replace(path.sep, "/")
+				with open(path.join(root, file), "rb") as f:
+					body = f.read()
+				encodings = {"identity": body, "gzip": gzip.compress(body, 9)}
+				assets[name] = {
+					"type": self.CONTENT_TYPES[extension],
+					"etag": f'"{hashlib.sha1(body).hexdigest()[:20]}"',
+					# pages are revalidated, so that changes are picked up on the next load
+					"cache": "no-cache" if extension == ".html" else "public, max-age=86400",
+					"encodings": {key: value for key, value in encodings.items() if len(value) <= len(body)},
+				}
+		return assets
+
+	async def serve_asset(self, path_, headers):
+		"""Answer plain HTTP requests with static files, let websocket handshakes through."""
+		if headers.get("Upgrade", "").lower() == "websocket":
+			return None
+		name = path_.split("?")[0]
+		name = self.INDEX if name == "/" else name
+		if name not in self.assets:
+			return HTTPStatus.NOT_FOUND, [("Content-Type", "text/plain")], b"Not found"
+		asset = self.assets[name]
+		response = [("ETag", asset["etag"]), ("Cache-Control", asset["cache"]), ("Vary", "Accept-Encoding"),
+					("Content-Type", asset["type"])]
+		if asset["etag"] in [tag.strip() for tag in headers.get("If-None-Match", "").split(",")]:
+			return HTTPStatus.NOT_MODIFIED, response, b""
+		gzipped = "gzip" in asset["encodings"] and self._accepts(headers.get("Accept-Encoding", ""), "gzip")
+		encoding = "gzip" if gzipped else "identity"
+		body = asset["encodings"][encoding]
+		if encoding != "identity":
+			response.append(("Content-Encoding", encoding))
+		return HTTPStatus.OK, response, body
+
 	async def thread(self, client, _):
 		"""Handle all incoming connections and messages from clients."""
 		self.connect(client)  # connect user
@@ -122,14 +208,25 @@ class Server:
 				try:
 					message = await client.recv()
 					self.update(client)  # now message was received at timestamp
+					if not self.throttle(client):
+						self.drop(client, "rate")
+						self.log_client(client, "rate", f'ERROR! {self.id(client)} is sending too many messages, dropping.', 2)
+						continue
 					message = json.loads(message)  # convert to dict
 
 					# see if message object has all required fields
-					if "type" not in message or "data" not in message:
-						self.log(f'ERROR! Message should consist of: {"type":"str", "data":{...}}.', 2)
+					if not isinstance(message, dict) or "type" not in message or "data" not in message \
+							or not isinstance(message["data"], dict):
+						self.drop(client, "invalid")
+						self.log_client(client, "format", 'ERROR! Message should consist of: {"type":"str", "data":{...}}.', 2)
 						continue
 					elif message["type"] not in ("info", "game"):
-						self.log(f'ERROR! Message type can be either "info" or "game".', 2)
+						self.drop(client, "invalid")
+						self.log_client(client, "type", f'ERROR! Message type can be either "info" or "game".', 2)
+						continue
+					elif len(message["data"]) > self.max_keys:
+						self.drop(client, "keys")
+						self.log_client(client, "keys", f'ERROR! Message data can have at most {self.max_keys} keys.', 2)
 						continue
 
 					# receiving user info / form values
@@ -153,10 +250,10 @@ class Server:
 								# in case a game environment was already connected
 								await self.broadcast({"exit": False})
 							else:
-								self.log(f'ERROR! Subject id is invalid.', 2)
+								self.log_client(client, "sid", f'ERROR! Subject id is invalid.', 2)
 								continue
 						if "sid" not in self.environment:
-							self.log(f'ERROR! All messages will be ignored until "sid" is set.', 2)
+							self.log_client(client, "no_sid", f'ERROR! All messages will be ignored until "sid" is set.', 2)
 							continue
 
 						# check data
@@ -179,13 +276,13 @@ class Server:
 							elif key.startswith("form_"):
 								self.save_info(key, value)
 							elif key != "sid":
-								self.log(f'ERROR! Unknown "info" key "{key}"', 2)
+								self.log_client(client, "unknown_key", f'ERROR! Unknown "info" key "{key}"', 2)
 
 					# receiving game data
 					elif message["type"] == "game":
 
 						if "sid" not in self.environment:
-							self.log(f'ERROR! All messages will be ignored until "sid" is set.', 2)
+							self.log_client(client, "no_sid", f'ERROR! All messages will be ignored until "sid" is set.', 2)
 							await self.send(client, "error", {"message": "Subject ID and information is not yet given."})
 							continue
 						
@@ -194,7 +291,7 @@ class Server:
 							ready = True
 							for test in ("nick", "avatar", "gender"):
 								if test not in self.environment:
-									self.log(f'The game can not start until the subject has set their {test}', 2)
+									self.log_client(client, f"profile_{test}", f'The game can not start until the subject has set their {test}', 2)
 									ready = False
 							if ready:
 								if "ready" not in self.environment or not self.environment["ready"]:
@@ -220,7 +317,7 @@ class Server:
 							else:
 								await self.send(client, "error", {"message": "Connection was refused because the subject's profile is not yet set up correctly."})
 						if "ready" not in self.environment or not self.environment["ready"]:
-							self.log('ERROR! Subject needs to set up their profile before the experiment can start.', 2)
+							self.log_client(client, "not_ready", 'ERROR! Subject needs to set up their profile before the experiment can start.', 2)
 							await self.send(client, "error", {"message": "Subject is not ready setting up their profile."})
 							continue
 
@@ -257,24 +354,33 @@ class Server:
 								#await self.send(client, "game", {"exit": True})
 								self.log(f'Subject {self.id(client)} has disconnected', 1)
 							elif key != "connect":
-								self.log(f'ERROR! Unknown "game" key "{key}"', 2)
+								self.log_client(client, "unknown_key", f'ERROR! Unknown "game" key "{key}"', 2)
 
 				except json.decoder.JSONDecodeError:
-					self.log(f'ERROR! {self.id(client)} has sent malformed JSON data.', 2)
+					self.drop(client, "invalid")
+					self.log_client(client, "json", f'ERROR! {self.id(client)} has sent malformed JSON data.', 2)
 					continue
 
 		# disconnecting
-		except websockets.ConnectionClosed:
+		except websockets.ConnectionClosed as ec:
+			# frames exceeding "max_size" close the connection (1006), the cause is kept by websockets
+			if isinstance(ec.__cause__, websockets.PayloadTooBig):
+				self.drop(client, "size")
+				self.log(f'ERROR! {self.id(client)} has sent a payload that is too large to process.', 2)
 			self.log(f'{self.id(client)} has disconnected', 1)
 		except websockets.WebSocketProtocolError:
 			self.log(f'ERROR! {self.id(client)} broke protocol.', 2)
-		except websockets.PayloadTooBig:
-			self.log(f'ERROR! {self.id(client)} has sent a payload that is too large to process.', 2)
 		except Exception as e:
 			# requires attention even from the researcher, therefor this error has log_level=1
 			self.log(f'ERROR! {self.id(client)} has caused an unknown exception: {e}.', 1)
 		finally:
 			try:
+				if client in self.connections:
+					for error, logged in self.connections[client]["errors"].items():
+						if logged["repeated"]:
+							self.log(f'{logged["msg"]} ({error} repeated {logged["repeated"]} more times)', 2)
+					if any(self.connections[client]["dropped"].values()):
+						self.log(f'{self.id(client)} had dropped messages: {self.connections[client]["dropped"]}', 2)
 				self.disconnect(client)
 			except Exception as e:
 				self.log(f'{self.id(client)} failed to disconnect safely: {e}.', 2)
@@ -288,6 +394,10 @@ class Server:
 			"connected": self.now(),
 			"updated": self.now(),
 			"ip": (client.remote_address[0] if client.remote_address else "0.0.0.0"),
+			"tokens": self.rate_burst,
+			"refilled": self.now(),
+			"dropped": {"rate": 0, "size": 0, "keys": 0, "invalid": 0},
+			"errors": {},
 		}
 		self.connections[client] = {**default, **data}
 
@@ -301,6 +411,29 @@ class Server:
 		if client in self.connections:
 			self.connections[client]["updated"] = self.now()
 
+	def throttle(self, client):
+		"""Token bucket rate limit, return False if message from client should be dropped."""
+		if client not in self.connections or self.rate_limit <= 0:
+			return True
+		connection = self.connections[client]
+		now = self.now()
+		elapsed = now - connection["refilled"]
+		connection["refilled"] = now
+		connection["tokens"] = min(self.rate_burst, connection["tokens"] + elapsed * self.rate_limit)
+		if connection["tokens"] < 1.:
+			return False
+		connection["tokens"] -= 1.
+		return True
+
+	def drop(self, client, reason):
+		"""Count dropped messages of client by reason."""
+		if client in self.connections:
+			self.connections[client]["dropped"][reason] += 1
+
+	def dropped(self):
+		"""Return number of dropped messages for each connected client."""
+		return {self.id(client): dict(self.connections[client]["dropped"]) for client in self.connections}
+
 	def terminate(self):
 		"""Terminate experiment and allow a new one"""
 		self.environment = {}
@@ -405,6 +538,23 @@ class Server:
 		except Exception as ep:
 			self.log(f"ERROR! Unable to send payload to {self.id(client)}: {ep}.", 2)
 
+	@staticmethod
+	def _accepts(header, encoding):
+		"""Check if an Accept-Encoding header allows encoding (q-value above 0, explicit or by "*")."""
+		quality = {}
+		for item in header.split(","):
+			name, *params = [part.strip() for part in item.split(";")]
+			q = 1.
+			for param in params:
+				if param.lower().startswith("q="):
+					try:
+						q = float(param[2:])
+					except ValueError:
+						q = 0.
+			if name:
+				quality[name.lower()] = q
+		return quality.get(encoding, quality.get("*", 0.)) > 0
+
 	@staticmethod
 	def _for_csv(value):
 		return str(value).strip().replace(';', ',')
@@ -441,7 +591,15 @@ if __name__ == "__main__":
 	parser.add_argument("--log_folder", help="Folder for logs", type=str, default="../experiments", required=False)
 	parser.add_argument("--log_info", help="File name of Info logs in 'log_folder'", type=str, default=f"{Server.now('%Y-%m-%d')}_info.csv", required=False)
 	parser.add_argument("--log_game", help="File name of Info logs in 'log_folder'", type=str, default=f"{Server.now('%Y-%m-%d')}_game.csv", required=False)
+	parser.add_argument("--log_interval", help="Seconds between logging the same client error again, defaults to 5", type=float, default=5., required=False)
+	parser.add_argument("--rate_limit", help="Messages per second per connection, 0 disables, defaults to 20", type=float, default=20., required=False)
+	parser.add_argument("--rate_burst", help="Messages a connection can send at once, defaults to 40", type=int, default=40, required=False)
+	parser.add_argument("--max_size", help="Maximum size of a single message in bytes, defaults to 65536", type=int, default=2 ** 16, required=False)
+	parser.add_argument("--max_keys", help="Maximum number of keys in message data, defaults to 16", type=int, default=16, required=False)
+	parser.add_argument("--static_folder", help="Folder of frontend files served over HTTP, empty to disable", type=str, default=path.join(path.dirname(path.abspath(__file__)), ".."), required=False)
 	args = parser.parse_args()
-	server = Server(ip=args.ip, port=args.port, log_level=args.log_level, log_folder=args.log_folder, log_info=args.log_info, log_game=args.log_game)
+	server = Server(ip=args.ip, port=args.port, log_level=args.log_level, log_folder=args.log_folder, log_info=args.log_info, log_game=args.log_game,
+					rate_limit=args.rate_limit, rate_burst=args.rate_burst, max_size=args.max_size, max_keys=args.max_keys, log_interval=args.log_interval,
+					static_folder=args.static_folder)
 	server.run()
 